@@ -2,28 +2,105 @@
 import requests
 import json
 import os
+import time
+import threading
 import logging as log_root
 from ollama import Client
 
 import src.utils.log_level_converter as log_level_converter
-
-log_root.basicConfig(
+import src.utils.log_pipeline as log_pipeline
+import src.utils.intake_rollup as intake_rollup
+import src.utils.api_dates as api_dates
+import src.utils.projection as projection
+import src.utils.token_budget as token_budget
+import src.utils.retrieval as retrieval
+from src.utils.session_store import SessionStore
+from src.utils.doc_mirror import DocumentMirror, SyncWorker
+import src.utils.answer_cache as answer_cache
+
+log_pipeline.setup(
     level=log_level_converter.convert_string_to_logger_level(os.getenv("logger_level")),
-    format='%(asctime)s - %(name)s - [%(levelname)s]: %(message)s', datefmt="%H:%M:%S")
+    fmt='%(asctime)s - %(name)s - [%(levelname)s]: %(message)s', datefmt="%H:%M:%S",
+    payload_sample_rate=float(os.getenv("log_payload_sample_rate", "0")))
 
 log = log_root.getLogger(__name__)
 
 # set global vars
 ollama_host = os.getenv("ollama_host")
 ollama_model = os.getenv("ollama_model")
+# small model for the tool selection, the answer is formulated by ollama_model
+router_model = os.getenv("router_model") or ollama_model
+# keep both models loaded between requests
+ollama_keep_alive = os.getenv("ollama_keep_alive", "-1m")
 username = os.getenv("username")
 password = os.getenv("password")
+fluid_target_ml = float(os.getenv("fluid_target_ml", "1500"))
+nutrition_target_kcal = float(os.getenv("nutrition_target_kcal", "1500"))
+intake_rollup_max_days = int(os.getenv("intake_rollup_max_days", "14"))
+
+api_url = "https://api.optadatacare.de/api/fe"
+
+# optional background sync of the care documentation, off without interval
+sync_interval_seconds = os.getenv("sync_interval_seconds")
+sync_max_age_seconds = int(os.getenv("sync_max_age_seconds", "900"))
+
+# token budgets, per tool and for the whole context of a turn
+context_tokens = int(os.getenv("context_tokens", "8192"))
+answer_token_reserve = int(os.getenv("answer_token_reserve", "1024"))
+tool_token_budget = int(os.getenv("tool_token_budget", "1500"))
+tool_token_budgets = {
+  "get_berichteblatt": int(os.getenv("berichteblatt_token_budget", "2000")),
+  "get_biografie": int(os.getenv("biografie_token_budget", "1500")),
+}
+
+# semantic retrieval over free text documents, disabled without embedding model
+embedding_model = os.getenv("embedding_model")
+retrieval_top_k = int(os.getenv("retrieval_top_k", "5"))
+retrieval_max_indexes = int(os.getenv("retrieval_max_indexes", "500"))
+retrieval_max_idle_seconds = int(os.getenv("retrieval_max_idle_seconds", str(8 * 60 * 60)))
+
+# cached answers, keyed on question and tool outputs; tool selection cache is off with ttl 0
+answer_cache_ttl_seconds = int(os.getenv("answer_cache_ttl_seconds", "600"))
+tool_selection_cache_ttl_seconds = int(os.getenv("tool_selection_cache_ttl_seconds", "0"))
+cache_max_entries = int(os.getenv("cache_max_entries", "1000"))
+
+# fields each tool passes on to the model
+client_data_fields = ["vorname", "name", "geburtsdatum", "strasse", "hausnummer", "plz", "ort", "telefon", "pflegegrad"]
+sis_ambulant_fields = None
+accident_report_fields = None
+
+system_prompt = "Du bist ein hilfreicher Assistent und beantwortest Fragen von Benutzer. Dazu nutzt du Informationen aus den Tools."
+
+# conversations of all staff sessions, older turns are trimmed to session_history_tokens
+session_history_tokens = int(os.getenv("session_history_tokens", "2048"))
+session_store = SessionStore(
+  max_bytes=int(os.getenv("session_store_max_bytes", str(64 * 1024 * 1024))),
+  max_idle_seconds=int(os.getenv("session_max_idle_seconds", str(8 * 60 * 60))),
+  spill_dir=os.getenv("session_spill_dir"),
+  max_spill_bytes=int(os.getenv("session_max_spill_bytes", str(512 * 1024 * 1024)))
+)
+
+answers = answer_cache.TTLCache(cache_max_entries, answer_cache_ttl_seconds) if answer_cache_ttl_seconds > 0 else None
+tool_selections = (answer_cache.TTLCache(cache_max_entries, tool_selection_cache_ttl_seconds)
+                   if tool_selection_cache_ttl_seconds > 0 else None)
 
 ollama_client = Client(
   host=ollama_host
 )
 
+def embed(texts: list) -> list:
+  return ollama_client.embed(model=embedding_model, input=texts)["embeddings"]
+
+
+# access token is reused until shortly before it expires
+access_token = {"token": None, "expires_at": 0.0}
+access_token_lock = threading.Lock()
+
 def get_access_token() -> str:
+  with access_token_lock:
+    if access_token["token"] and time.time() < access_token["expires_at"]:
+      return access_token["token"]
+
   payload = {
     'grant_type': 'password',
     'client_id': 'optadata-care',
@@ -33,18 +110,35 @@ def get_access_token() -> str:
   response = requests.post("https://login.login-one.de/auth/realms/one/protocol/openid-connect/token",
                     headers={"Content-Type": "application/x-www-form-urlencoded"},
                     data=payload)
-  return response.json()["access_token"]
+  token_response = response.json()
+
+  with access_token_lock:
+    access_token["token"] = token_response["access_token"]
+    access_token["expires_at"] = time.time() + int(token_response.get("expires_in", 60)) - 30
+  return access_token["token"]
+
+
+document_mirror = DocumentMirror(api_url, get_access_token, sync_max_age_seconds)
+sync_worker = None
+if sync_interval_seconds:
+  sync_worker = SyncWorker(document_mirror, int(sync_interval_seconds))
+  sync_worker.start()
+
+
+def fetch(path: str):
+  # mirrored documents first, if the sync is running
+  if sync_worker is not None:
+    return document_mirror.fetch(path)
+  return requests.get(api_url + path, headers={"Authorization": "Bearer " + get_access_token()})
 
 
 def get_client_id(firstname: str, lastname: str) -> str:
-  token = get_access_token()
-  log.debug("get_client_id function called with: " + firstname + " " + lastname + "")
+  log.debug("get_client_id function called with: %s %s", firstname, lastname)
 
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/klient", headers=headers)
+  data = fetch("/klient")
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_client_id function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_client_id function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type dict
@@ -59,14 +153,12 @@ def get_client_id(firstname: str, lastname: str) -> str:
 
 
 def get_client_document_id(client_id: str, document_typ: str) -> str:
-  token = get_access_token()
-  log.debug("get_client_document_id function called with: " + client_id + " " + document_typ + "")
+  log.debug("get_client_document_id function called with: %s %s", client_id, document_typ)
 
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/klient/" + client_id + "/pflegedoku", headers=headers)
+  data = fetch("/klient/" + client_id + "/pflegedoku")
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_client_document_id function called with: " + client_id + " " + document_typ + "")
+    log.error("Error at api call - %s get_client_document_id function called with: %s %s", data.status_code, client_id, document_typ)
     return "error at api call"
 
   #type dict
@@ -98,14 +190,12 @@ def get_client_data(firstname: str, lastname: str) -> str:
     str: Wohnort des clienten
   """
 
-  token = get_access_token()
-  log.debug("get_client_data function called with: " + firstname + " " + lastname + "")
+  log.debug("get_client_data function called with: %s %s", firstname, lastname)
 
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/klient", headers=headers)
+  data = fetch("/klient")
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_client_data function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_client_data function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type dict
@@ -113,7 +203,12 @@ def get_client_data(firstname: str, lastname: str) -> str:
 
   for client in clients["content"]:
     if client["person"]["name"] == lastname and client["person"]["vorname"] == firstname:
-      return str(client)
+      record = projection.project(client, projection.ClientRecord)
+      client_data = projection.serialize(record, client_data_fields)
+
+      # fallback for fields that are not where the projection expects them
+      missed = projection.serialize_fallback(client, record, client_data_fields)
+      return "; ".join(part for part in (client_data, missed) if part)
 
   log.info("Client not found")
   return "Client not found"
@@ -132,24 +227,37 @@ def get_berichteblatt(firstname: str, lastname: str) -> str:
     str: Bericht zum Klienten
   """
 
-  log.debug("get_berichteblatt function called with: " + firstname + " " + lastname + "")
+  log.debug("get_berichteblatt function called with: %s %s", firstname, lastname)
 
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, 'BERICHTEBLATT')
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/berichteblatteintrag/" + document_id, headers=headers)
+  data = fetch("/berichteblatteintrag/" + document_id)
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_berichteblatt function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_berichteblatt function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type list
   report_entries = json.loads(data.text)
-  combined_entries = ""
-  for eintrag in report_entries:
-    combined_entries = combined_entries + "\n" + " " + eintrag["content"]["bericht"] + ". "
+
+  # newest entries first, entries without date keep the (chronological) api order reversed
+  report_entries = sorted(reversed(report_entries), reverse=True,
+                          key=lambda eintrag: api_dates.entry_date(eintrag["content"], eintrag) or "")
+  reports = [" " + eintrag["content"]["bericht"] + ". " for eintrag in report_entries if eintrag["content"].get("bericht")]
+
+  question = token_budget.current_question()
+  if embedding_model and question:
+    # only the report chunks closest to the question
+    try:
+      index = retrieval.get_index(client_id + "/BERICHTEBLATT", embed, retrieval_max_indexes, retrieval_max_idle_seconds)
+      index.add([(str(eintrag.get("id") or eintrag["content"]["bericht"]), eintrag["content"]["bericht"])
+                 for eintrag in report_entries if eintrag["content"].get("bericht")])
+      reports = index.search(question, retrieval_top_k) or reports
+    except Exception:
+      log.exception("Retrieval failed, get_berichteblatt falls back to the newest entries")
+
+  combined_entries = token_budget.truncate_entries(reports, token_budget.budget(tool_token_budgets["get_berichteblatt"]))
 
   if not combined_entries:
     log.info("No report entries found")
@@ -171,17 +279,15 @@ def get_vitalwerte(firstname: str, lastname: str) -> str:
     str: Vitalwerte zur Person
   """
 
-  log.debug("get_vitalwerte function called with: " + firstname + " " + lastname + "")
+  log.debug("get_vitalwerte function called with: %s %s", firstname, lastname)
 
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, 'VITALWERTE')
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/vitalwerte/" + document_id, headers=headers)
+  data = fetch("/vitalwerte/" + document_id)
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_vitalwerte function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_vitalwerte function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type dict
@@ -205,34 +311,27 @@ def get_fluessigkeitbilanz(firstname: str, lastname: str) -> str:
     str: Fluessigkeitsbilanz zum Klienten
   """
 
-  log.debug("get_fluessigkeitbilanz function called with: " + firstname + " " + lastname + "")
+  log.debug("get_fluessigkeitbilanz function called with: %s %s", firstname, lastname)
 
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, 'FLUESSIGKEITSBILANZIERUNG')
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/fluessigkeitsbilanzierung/" + document_id + "/alle-eintraege", headers=headers)
+  data = fetch("/fluessigkeitsbilanzierung/" + document_id + "/alle-eintraege")
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_fluessigkeitbilanz function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_fluessigkeitbilanz function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type list
   fluid_intake_data = json.loads(data.text)
 
-  combined_entries = ""
-  for entry in fluid_intake_data:
-    for sub_entry in entry["subEintraege"]:
-      combined_entries = (combined_entries + "\n" + firstname + " " + lastname + " hat " + str(sub_entry["content"]["einfuhrmenge"]) + " ml " +
-                          str(sub_entry["content"]["fluessigkeit"]) + " getrunken. Er hat " + str(sub_entry["content"]["ausfuhrmenge"]) +
-                          " ml " + str(sub_entry["content"]["fluessigkeit"]) +" ausgeschieden.")
+  combined_entries = intake_rollup.rollup_fluid_balance(fluid_intake_data, fluid_target_ml, intake_rollup_max_days)
 
-    if not combined_entries:
-      log.info("No fluid intake data found")
-      return "No fluid intake data found"
+  if not combined_entries:
+    log.info("No fluid intake data found")
+    return "No fluid intake data found"
 
-    return combined_entries
+  return "Fluessigkeitsbilanz von " + firstname + " " + lastname + " pro Tag (Ziel " + str(int(fluid_target_ml)) + " ml):\n" + combined_entries
 
 def get_ernaehrung(firstname: str, lastname: str) -> str:
   """
@@ -246,34 +345,27 @@ def get_ernaehrung(firstname: str, lastname: str) -> str:
     str: Ernaehrung oral des Klienten
   """
 
-  log.debug("get_ernaehrung function called with: " + firstname + " " + lastname + "")
+  log.debug("get_ernaehrung function called with: %s %s", firstname, lastname)
 
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, 'ERNAEHRUNG_ORAL')
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/ernaehrung-oral/" + document_id + "/alle-eintraege", headers=headers)
+  data = fetch("/ernaehrung-oral/" + document_id + "/alle-eintraege")
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_ernaehrung function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_ernaehrung function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type list
   oral_nutrition = json.loads(data.text)
 
-  combined_entries = ""
-  for entry in oral_nutrition:
-    for sub_entry in entry["subEintraege"]:
-      combined_entries = (combined_entries + "\n" + firstname + " " + lastname + " hat " + str(sub_entry["content"]["mahlzeit"]) + " als " +
-                          str(sub_entry["content"]["lebensmittel"]) + " gegessen. Er hat dadurch " + str(sub_entry["content"]["kcal"]) +
-                          " Kalorie/n zu sich genommen.")
+  combined_entries = intake_rollup.rollup_nutrition(oral_nutrition, nutrition_target_kcal, intake_rollup_max_days)
 
-    if not combined_entries:
-      log.info("No oral nutrition found")
-      return "No oral nutrition found"
+  if not combined_entries:
+    log.info("No oral nutrition found")
+    return "No oral nutrition found"
 
-    return combined_entries
+  return "Ernaehrung von " + firstname + " " + lastname + " pro Tag (Ziel " + str(int(nutrition_target_kcal)) + " kcal):\n" + combined_entries
 
 # Medikationsplan
 def get_medikationsplan(firstname: str, lastname: str) -> str:
@@ -288,18 +380,16 @@ def get_medikationsplan(firstname: str, lastname: str) -> str:
     str: Medikationsplan zum Klienten
   """
 
-  log.debug("get_medikationsplan function called with: " + firstname + " " + lastname + "")
+  log.debug("get_medikationsplan function called with: %s %s", firstname, lastname)
 
   #medikationsplan_id = "56d318a0-dbd4-41a7-8fb1-827469eaba19"
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, "MEDIKATIONSPLAN")
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/medikationsplaneintrag/" + document_id, headers=headers)
+  data = fetch("/medikationsplaneintrag/" + document_id)
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_medikationsplan function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_medikationsplan function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #if data.status_code == 200:
@@ -332,17 +422,15 @@ def get_massnahmenplan(firstname: str, lastname: str) -> str:
     str: Massnahmenplan zum Klienten
   """
 
-  log.debug("get_massnahmenplan function called with: " + firstname + " " + lastname + "")
+  log.debug("get_massnahmenplan function called with: %s %s", firstname, lastname)
 
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, 'MASSNAHMENPLAN')
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/massnahmenplan/" + document_id + "/alle-eintraege", headers=headers)
+  data = fetch("/massnahmenplan/" + document_id + "/alle-eintraege")
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_massnahmenplan function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_massnahmenplan function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type list
@@ -371,29 +459,47 @@ def get_biografie(firstname: str, lastname: str) -> str:
     str: Biografie zum Klienten in JSON Format
   """
 
-  log.debug("get_biografie function called with: " + firstname + " " + lastname + "")
+  log.debug("get_biografie function called with: %s %s", firstname, lastname)
 
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, "BIOGRAFIEBOGEN")
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/biografiebogen/" + document_id, headers=headers)
+  data = fetch("/biografiebogen/" + document_id)
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_biografie function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_biografie function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type dict
   biografie = json.loads(data.text)
 
-  combined_entries = ""
+  sections = []
   for entry, content in biografie.items():
     if isinstance(content, dict):
+      section = ""
       for current_index in content:
         if content[current_index] is None:
           continue
-        combined_entries = (combined_entries + " \n" + content[current_index] + ". ")
+        section = section + " \n" + str(content[current_index]) + ". "
+      if section:
+        sections.append((entry, section))
+
+  question = token_budget.current_question()
+  chunks = []
+  if embedding_model and question:
+    # only the biography chunks closest to the question
+    try:
+      index = retrieval.get_index(client_id + "/BIOGRAFIEBOGEN", embed, retrieval_max_indexes, retrieval_max_idle_seconds)
+      index.add(sections)
+      chunks = [" \n" + chunk for chunk in index.search(question, retrieval_top_k)]
+    except Exception:
+      log.exception("Retrieval failed, get_biografie falls back to ranking by shared words")
+
+  # without retrieval the sections sharing the most words with the question first
+  sections = chunks or token_budget.rank_by_question([section for entry, section in sections])
+
+  combined_entries = token_budget.truncate_entries(sections,
+                                                   token_budget.budget(tool_token_budgets["get_biografie"]), separator="")
 
   if not combined_entries:
     log.info("No biografie found")
@@ -417,21 +523,25 @@ def get_sis_ambulant(firstname: str, lastname: str) -> str:
   #medikationsplan_id = "56d318a0-dbd4-41a7-8fb1-827469eaba19"
   #sis_ambulant_id = "41bc7176-a264-404d-a5fe-d56ed82b8c2b"
 
-  log.debug("get_sis_ambulant function called with: " + firstname + " " + lastname + "")
+  log.debug("get_sis_ambulant function called with: %s %s", firstname, lastname)
 
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, "SIS_AMBULANT")
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/sis-ambulant/" + document_id, headers=headers)
+  data = fetch("/sis-ambulant/" + document_id)
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_sis_ambulant function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_sis_ambulant function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type dict
-  result = json.loads(data.text)
+  ambulant_info = json.loads(data.text)
+
+  result = projection.serialize(projection.project(ambulant_info, projection.SisRecord), sis_ambulant_fields)
+
+  if not result:
+    log.info("No sis ambulant found")
+    return "No sis ambulant found"
 
   return result
 
@@ -448,17 +558,15 @@ def get_current_needs(firstname: str, lastname: str) -> str:
 
   """
 
-  log.debug("get_current_needs function called with: " + firstname + " " + lastname + "")
+  log.debug("get_current_needs function called with: %s %s", firstname, lastname)
 
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, "SIS_AMBULANT")
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/sis-ambulant/" + document_id, headers=headers)
+  data = fetch("/sis-ambulant/" + document_id)
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_current_needs function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_current_needs function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type dict
@@ -492,17 +600,15 @@ def get_cognitive_and_communicative_skills(firstname: str, lastname: str) -> str
 
   """
 
-  log.debug("get_cognitive_and_communicative_skills function called with: " + firstname + " " + lastname + "")
+  log.debug("get_cognitive_and_communicative_skills function called with: %s %s", firstname, lastname)
 
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, "SIS_AMBULANT")
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/sis-ambulant/" + document_id, headers=headers)
+  data = fetch("/sis-ambulant/" + document_id)
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_cognitive_and_communicative_skills function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_cognitive_and_communicative_skills function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type dict
@@ -536,17 +642,15 @@ def get_mobility_and_agility_skills(firstname: str, lastname: str) -> str:
 
   """
 
-  log.debug("get_mobility_and_agility_skills function called with: " + firstname + " " + lastname + "")
+  log.debug("get_mobility_and_agility_skills function called with: %s %s", firstname, lastname)
 
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, "SIS_AMBULANT")
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/sis-ambulant/" + document_id, headers=headers)
+  data = fetch("/sis-ambulant/" + document_id)
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_mobility_and_agility_skills function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_mobility_and_agility_skills function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type dict
@@ -580,17 +684,15 @@ def get_illness_related_demands_and_stresses(firstname: str, lastname: str) -> s
 
   """
 
-  log.debug("get_illness_related_demands_and_stresses function called with: " + firstname + " " + lastname + "")
+  log.debug("get_illness_related_demands_and_stresses function called with: %s %s", firstname, lastname)
 
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, "SIS_AMBULANT")
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/sis-ambulant/" + document_id, headers=headers)
+  data = fetch("/sis-ambulant/" + document_id)
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_illness_related_demands_and_stresses function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_illness_related_demands_and_stresses function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type dict
@@ -624,17 +726,15 @@ def get_self_sufficiency(firstname: str, lastname: str) -> str:
 
   """
 
-  log.debug("get_self_sufficiency function called with: " + firstname + " " + lastname + "")
+  log.debug("get_self_sufficiency function called with: %s %s", firstname, lastname)
 
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, "SIS_AMBULANT")
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/sis-ambulant/" + document_id, headers=headers)
+  data = fetch("/sis-ambulant/" + document_id)
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_self_sufficiency function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_self_sufficiency function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type dict
@@ -668,17 +768,15 @@ def get_social_relationships(firstname: str, lastname: str) -> str:
 
   """
 
-  log.debug("get_social_relationships function called with: " + firstname + " " + lastname + "")
+  log.debug("get_social_relationships function called with: %s %s", firstname, lastname)
 
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, "SIS_AMBULANT")
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/sis-ambulant/" + document_id, headers=headers)
+  data = fetch("/sis-ambulant/" + document_id)
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_social_relationships function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_social_relationships function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type dict
@@ -712,17 +810,15 @@ def get_household_management(firstname: str, lastname: str) -> str:
 
   """
 
-  log.debug("get_household_management function called with: " + firstname + " " + lastname + "")
+  log.debug("get_household_management function called with: %s %s", firstname, lastname)
 
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, "SIS_AMBULANT")
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/sis-ambulant/" + document_id, headers=headers)
+  data = fetch("/sis-ambulant/" + document_id)
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_household_management function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_household_management function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
   #type dict
@@ -757,80 +853,174 @@ def get_accident_report(firstname: str, lastname: str) -> str:
     str: Sturzprotokoll Information zur Person
   """
 
-  log.debug("get_accident_report function called with: " + firstname + " " + lastname + "")
+  log.debug("get_accident_report function called with: %s %s", firstname, lastname)
 
   client_id = get_client_id(firstname, lastname)
   document_id = get_client_document_id(client_id, 'STURZPROTOKOLL')
 
-  token = get_access_token()
-  headers = {"Authorization": "Bearer " + token}
-  data = requests.get("https://api.optadatacare.de/api/fe/sturzprotokoll/" + document_id, headers=headers)
+  data = fetch("/sturzprotokoll/" + document_id)
 
   if data.status_code != 200:
-    log.error("Error at api call - " + str(data.status_code) + " get_accident_report function called with: " + firstname + " " + lastname + "")
+    log.error("Error at api call - %s get_accident_report function called with: %s %s", data.status_code, firstname, lastname)
     return "error at api call"
 
+  #type dict
   accident_report_info = json.loads(data.text)
 
-# type Dictionary
-  report_info = ""
-  for content in accident_report_info.values():
-    if isinstance(content, dict):
-      for value in content:
-        if content[value] is None:
-          continue
-        report_info = report_info + "\n" + content[value] + "."
+  record = projection.project(accident_report_info, projection.SturzprotokollRecord)
+  report_info = projection.serialize(record, accident_report_fields)
+
+  # fallback for protocols whose fields are not all covered by the projection
+  if any(getattr(record, name) is None for name in accident_report_fields or projection.SturzprotokollRecord.PATHS):
+    unmatched = projection.serialize_unmatched(accident_report_info, projection.SturzprotokollRecord)
+    report_info = "; ".join(part for part in (report_info, unmatched) if part)
+
+  if not report_info:
+    log.info("No accident report found")
+    return "No accident report found"
+
   return report_info
 
 
+def valid_tool_calls(response, tool_names: set) -> list:
+  # all tools take the name of the client
+  return [tool for tool in response.message.tool_calls or []
+          if tool.function.name in tool_names and set(tool.function.arguments or {}) == {"firstname", "lastname"}]
+
+
+tools = [get_client_data, get_berichteblatt, get_vitalwerte, get_fluessigkeitbilanz,
+         get_ernaehrung, get_medikationsplan,get_massnahmenplan, get_sis_ambulant,
+         get_current_needs,get_cognitive_and_communicative_skills,get_mobility_and_agility_skills,
+         get_illness_related_demands_and_stresses,get_self_sufficiency,
+         get_social_relationships,get_household_management, get_biografie, get_accident_report]
+tools_by_name = {tool.__name__: tool for tool in tools}
+
+
 def agent(messages: list) -> list:
 
+  tool_names = set(tools_by_name)
+  question = next((message["content"] for message in reversed(messages) if message["role"] == "user"), "")
+  normalized_question = answer_cache.normalize_question(question)
+
   # Findet das richtige Tool zur Anfrage
-  response = ollama_client.chat(
-    model=ollama_model,
-    messages=messages,
-    tools=[get_client_data, get_berichteblatt, get_vitalwerte, get_fluessigkeitbilanz,
-           get_ernaehrung, get_medikationsplan,get_massnahmenplan, get_sis_ambulant,
-           get_current_needs,get_cognitive_and_communicative_skills,get_mobility_and_agility_skills,
-           get_illness_related_demands_and_stresses,get_self_sufficiency,
-           get_social_relationships,get_household_management, get_biografie, get_accident_report]
-  )
-
-  result = ""
-  for tool in response.message.tool_calls or []:
+  start = time.perf_counter()
+  tool_calls = tool_selections.get(normalized_question) if tool_selections is not None else None
+  cached_selection = tool_calls is not None
+  router_valid = True
+  if not cached_selection:
+    response = ollama_client.chat(
+      model=router_model,
+      messages=messages,
+      tools=tools,
+      keep_alive=ollama_keep_alive
+    )
+    tool_calls = valid_tool_calls(response, tool_names)
+    # a single invalid call may stand for a part of the question that would get lost
+    router_valid = bool(tool_calls) and len(tool_calls) == len(response.message.tool_calls or [])
+    if tool_calls and not router_valid:
+      log.warning("Router Modell %s lieferte ungueltige Tool Aufrufe: %s", router_model,
+                  [tool.function.name for tool in response.message.tool_calls if tool not in tool_calls])
+  timings = {"toolauswahl": round(time.perf_counter() - start, 2)}
+  log.debug("Latenz Toolauswahl (%s): %s s", router_model, timings["toolauswahl"])
+
+  # Fallback auf das grosse Modell, wenn das Router Modell kein oder ein ungueltiges Tool liefert
+  if not router_valid and router_model != ollama_model:
+    start = time.perf_counter()
+    response = ollama_client.chat(
+      model=ollama_model,
+      messages=messages,
+      tools=tools,
+      keep_alive=ollama_keep_alive
+    )
+    tool_calls = valid_tool_calls(response, tool_names)
+    timings["toolauswahl_fallback"] = round(time.perf_counter() - start, 2)
+    log.debug("Latenz Toolauswahl Fallback (%s): %s s", ollama_model, timings["toolauswahl_fallback"])
+
+  # only selections fully determined by the question are cached, "Was bekommt er?" refers
+  # to a different resident in every conversation
+  if (tool_selections is not None and tool_calls and not cached_selection and
+      all(str(value).lower() in normalized_question for tool in tool_calls for value in tool.function.arguments.values())):
+    tool_selections.put(normalized_question, tool_calls)
+
+  # names of the residents asked about are redacted from the logs
+  for tool in tool_calls:
+    log_pipeline.register_names(*tool.function.arguments.values())
+
+  # context left for the tool outputs of this turn
+  used_tokens = sum(token_budget.estimate_tokens(str(message["content"])) for message in messages)
+  token_budget.start_turn(context_tokens - answer_token_reserve - used_tokens, question)
+
+  start = time.perf_counter()
+  tool_sizes = {}
+  tool_outputs = []
+  for tool in tool_calls:
     kwargs = tool.function.arguments
-    result = result + " " + getattr(__import__("__main__"), tool.function.name)(**kwargs)
-    log.info("Ergebnis des Tools " + tool.function.name + ":" + result)
-    message = {"role": "tool", "tool_call_id": tool.function.name, "content": result}
+    tool_result = tools_by_name[tool.function.name](**kwargs)
+    tool_result = token_budget.truncate_text(tool_result, token_budget.budget(
+      tool_token_budgets.get(tool.function.name, tool_token_budget)))
+    token_budget.consume(tool_result)
+    tool_sizes[tool.function.name] = len(tool_result)
+    tool_outputs.append([tool.function.name, kwargs, answer_cache.fingerprint(tool_result)])
+    log.debug("Ergebnis des Tools %s: %s", tool.function.name, log_pipeline.Payload(tool_result))
+    message = {"role": "tool", "tool_call_id": tool.function.name, "content": tool_result}
     messages.append(message)
-
-  # Formuliert eine Antwort mit den Informationen aus den Tools
-  response = ollama_client.chat(
-    model=ollama_model,
-    messages=messages
-  )
-
-  message = {"role": "assistant", "content": response["message"]["content"]}
+  timings["tools"] = round(time.perf_counter() - start, 2)
+
+  # Formuliert eine Antwort mit den Informationen aus den Tools, gleiche Frage mit gleichen Daten aus dem Cache
+  start = time.perf_counter()
+  answer_key = answer_cache.fingerprint(normalized_question, tool_outputs)
+  # answers without tool data depend on the conversation and are not cached
+  use_answer_cache = answers is not None and bool(tool_outputs)
+  answer = answers.get(answer_key) if use_answer_cache else None
+  timings["antwort_cache"] = answer is not None
+  if answer is None:
+    response = ollama_client.chat(
+      model=ollama_model,
+      messages=messages,
+      keep_alive=ollama_keep_alive
+    )
+    answer = response["message"]["content"]
+    if use_answer_cache:
+      answers.put(answer_key, answer)
+  timings["antwort"] = round(time.perf_counter() - start, 2)
+
+  message = {"role": "assistant", "content": answer}
   messages.append(message)
-  log.info("Antwort des Assistants: " + message["content"])
+  log.info("Turn: modelle=%s/%s tools=%s zeichen=%s antwort=%s latenz_s=%s",
+           router_model, ollama_model, list(tool_sizes), tool_sizes, log_pipeline.Payload(message["content"]), timings)
   return messages
 
-#print(agent("Gib einen Bericht über Lukas Meister aus ?"))
-#print(agent("Welche Vitalwerte hat Lukas Meister ?"))
-#print(agent("Welche Fluessigkeitsbilanzierung hat Lukas Meister ?"))
-#print(agent("Was hat Lukas Meister gestern gegessen ?"))
-#print(agent("Welche Medikamente bekommt Lukas Meister ?"))
-#print(agent("Welche Maßnahmen sind für Lukas Meister vorgesehen ?"))
-#print(agent("In wie weit ist Lukas Meister in seiner Bewegung oder Mobilität eingeschränkt?"))
-
-messages=[
-    {"role": "system", "content": "Du bist ein hilfreicher Assistent und beantwortest Fragen von Benutzer. Dazu nutzt du Informationen aus den Tools."},
-    {"role": "user", "content": "Welche Medikamente bekommt Lukas Meister und welche Maßnahmen sind für ihn vorgesehen?"},
-    {"role": "tool", "tool_call_id": "get_client_id", "content": "Lukas Meister hat die ID 61a4f89e-6d6d-4fc5-842e-42d66ce51d45"},
-    {"role": "tool", "tool_call_id": "get_medikationsplan", "content": "Lukas Meister bekommt Bisoprolol als Medikamente STUECK_1 täglich. Die Medikamente nimmt Lukas als DAUERMEDIKATION. Lukas Meister bekommt Paracetamol als Medikamente STUECK_1 täglich. Die Medikamente nimmt Lukas als DAUERMEDIKATION."},
-    {"role": "tool", "tool_call_id": "get_massnahmenplan", "content": "Jeden morgen muss Lukas 10 Liegestütze machen. Jeden Mittag muss Lukas Proteine zu sich nehmen. Abends muss Lukas 10 Klimmzüge machen."},
-    {"role": "assistant", "content": "Lukas Meister bekommt täglich Bisoprolol und Paracetamol. Jeden morgen muss Lukas 10 Liegestütze machen. Jeden Mittag muss Lukas Proteine zu sich nehmen. Abends muss Lukas 10 Klimmzüge machen."},
-    {"role": "user", "content": "Hat Lukas Meister ein Sturzprotokoll?"},
-  ]
-
-log.info("agent messages: %s", agent(messages))
+def chat(session_id: str, question: str) -> str:
+  # one turn per session at a time, so concurrent requests do not lose a turn
+  with session_store.session_lock(session_id):
+    messages = session_store.get(session_id) or [{"role": "system", "content": system_prompt}]
+    messages.append({"role": "user", "content": question})
+    messages = token_budget.trim_turns(messages, session_history_tokens)
+
+    messages = agent(messages)
+
+    # tool results are already summarized in the answer
+    session_store.put(session_id, [message for message in messages if message["role"] != "tool"])
+    return messages[-1]["content"]
+
+if __name__ == "__main__":
+  #print(agent("Gib einen Bericht über Lukas Meister aus ?"))
+  #print(agent("Welche Vitalwerte hat Lukas Meister ?"))
+  #print(agent("Welche Fluessigkeitsbilanzierung hat Lukas Meister ?"))
+  #print(agent("Was hat Lukas Meister gestern gegessen ?"))
+  #print(agent("Welche Medikamente bekommt Lukas Meister ?"))
+  #print(agent("Welche Maßnahmen sind für Lukas Meister vorgesehen ?"))
+  #print(agent("In wie weit ist Lukas Meister in seiner Bewegung oder Mobilität eingeschränkt?"))
+
+  messages=[
+      {"role": "system", "content": system_prompt},
+      {"role": "user", "content": "Welche Medikamente bekommt Lukas Meister und welche Maßnahmen sind für ihn vorgesehen?"},
+      {"role": "tool", "tool_call_id": "get_client_id", "content": "Lukas Meister hat die ID 61a4f89e-6d6d-4fc5-842e-42d66ce51d45"},
+      {"role": "tool", "tool_call_id": "get_medikationsplan", "content": "Lukas Meister bekommt Bisoprolol als Medikamente STUECK_1 täglich. Die Medikamente nimmt Lukas als DAUERMEDIKATION. Lukas Meister bekommt Paracetamol als Medikamente STUECK_1 täglich. Die Medikamente nimmt Lukas als DAUERMEDIKATION."},
+      {"role": "tool", "tool_call_id": "get_massnahmenplan", "content": "Jeden morgen muss Lukas 10 Liegestütze machen. Jeden Mittag muss Lukas Proteine zu sich nehmen. Abends muss Lukas 10 Klimmzüge machen."},
+      {"role": "assistant", "content": "Lukas Meister bekommt täglich Bisoprolol und Paracetamol. Jeden morgen muss Lukas 10 Liegestütze machen. Jeden Mittag muss Lukas Proteine zu sich nehmen. Abends muss Lukas 10 Klimmzüge machen."},
+      {"role": "user", "content": "Hat Lukas Meister ein Sturzprotokoll?"},
+    ]
+
+  messages = agent(messages)
+  log.info("agent messages: %s Nachrichten, Antwort %s", len(messages), log_pipeline.Payload(messages[-1]["content"]))
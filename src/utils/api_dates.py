@@ -0,0 +1,17 @@
+# candidate date fields of documentation entries; the api responses available
+# so far do not show which one is used, so all are tried in order
+DATE_KEYS = ("datum", "zeitpunkt", "datumUhrzeit", "erstelltAm")
+
+
+def entry_date(*sources):
+    """
+    Get the date of an entry as ISO string from the first source dict that has one of DATE_KEYS, None otherwise
+    """
+    for source in sources:
+        if not isinstance(source, dict):
+            continue
+        for key in DATE_KEYS:
+            value = source.get(key)
+            if value:
+                return str(value)
+    return None
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import zlib
+
+import requests
+
+log = logging.getLogger(__name__)
+
+# document endpoints per pflegedoku document type
+DOCUMENT_PATHS = {
+    "BERICHTEBLATT": "/berichteblatteintrag/{id}",
+    "VITALWERTE": "/vitalwerte/{id}",
+    "FLUESSIGKEITSBILANZIERUNG": "/fluessigkeitsbilanzierung/{id}/alle-eintraege",
+    "ERNAEHRUNG_ORAL": "/ernaehrung-oral/{id}/alle-eintraege",
+    "MEDIKATIONSPLAN": "/medikationsplaneintrag/{id}",
+    "MASSNAHMENPLAN": "/massnahmenplan/{id}/alle-eintraege",
+    "BIOGRAFIEBOGEN": "/biografiebogen/{id}",
+    "SIS_AMBULANT": "/sis-ambulant/{id}",
+    "STURZPROTOKOLL": "/sturzprotokoll/{id}",
+}
+
+# fields of a pflegedoku document entry that change with its content
+CHANGE_MARKERS = ("geaendertAm", "aenderungsdatum", "zuletztGeaendert", "version")
+
+
+class MirroredResponse:
+    """
+    Successful api response served from the local mirror
+    """
+    __slots__ = ("text",)
+    status_code = 200
+
+    def __init__(self, text):
+        self.text = text
+
+
+class DocumentMirror:
+    """
+    Local compact copy of api responses, keyed by url
+
+    Responses are kept zlib compressed together with the time of their last
+    successful sync and the change marker of the document they belong to.
+    """
+
+    def __init__(self, base_url, get_token, max_age_seconds):
+        self.base_url = base_url
+        self.get_token = get_token
+        self.max_age_seconds = max_age_seconds
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.missing_marker_logged = False
+
+    def get(self, url):
+        """
+        Get a mirrored response, None if it is missing or older than max_age_seconds
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry is None or time.time() - entry[1] > self.max_age_seconds:
+            return None
+        return MirroredResponse(zlib.decompress(entry[0]).decode("utf-8"))
+
+    def put(self, url, text, marker=None):
+        """
+        Store a response, returns False if the same text was mirrored already
+        """
+        text_hash = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        with self.lock:
+            entry = self.entries.get(url)
+            changed = entry is None or entry[3] != text_hash
+            data = zlib.compress(text.encode("utf-8")) if changed else entry[0]
+            self.entries[url] = (data, time.time(), marker, text_hash)
+        return changed
+
+    def touch(self, url, marker):
+        """
+        Mark a mirrored response as current if its document did not change, returns False otherwise
+
+        Without change marker a mirrored document counts as unchanged until half of
+        max_age_seconds has passed, then it is downloaded again and compared by content hash.
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return False
+            if marker is None:
+                return entry[2] is None and time.time() - entry[1] < self.max_age_seconds / 2
+            if entry[2] != marker:
+                return False
+            self.entries[url] = (entry[0], time.time(), marker, entry[3])
+            return True
+
+    def fetch(self, path):
+        """
+        Get a response from the mirror, falls back to a live api call
+        """
+        url = self.base_url + path
+        mirrored = self.get(url)
+        if mirrored is not None:
+            return mirrored
+        data = requests.get(url, headers={"Authorization": "Bearer " + self.get_token()})
+        if data.status_code == 200:
+            self.put(url, data.text)
+        return data
+
+    def sync(self):
+        """
+        Walk the client list and the pflegedoku of every client, documents are
+        only downloaded if their change marker differs from the mirrored one,
+        documents without marker when their mirrored copy is due for a refresh
+        """
+        clients = self._download("/klient", {"Authorization": "Bearer " + self.get_token()})[0]
+        if clients is None:
+            return
+
+        downloaded = 0
+        changed = 0
+        for client in json.loads(clients)["content"]:
+            # get_token reuses its token until it expires, a full sync can outlast one
+            headers = {"Authorization": "Bearer " + self.get_token()}
+            client_id = str(client["id"])
+            documents = self._download("/klient/" + client_id + "/pflegedoku", headers)[0]
+            if documents is None:
+                continue
+
+            for document in json.loads(documents)["pflegedokuList"]:
+                path = DOCUMENT_PATHS.get(document["dokumenttyp"])
+                if path is None:
+                    continue
+                for document_entry in document["dokumente"]:
+                    url = self.base_url + path.format(id=document_entry["id"])
+                    marker = next((str(document_entry[key]) for key in CHANGE_MARKERS if document_entry.get(key)), None)
+                    if marker is None and not self.missing_marker_logged:
+                        # the marker fields are not confirmed by an api response, see touch for the fallback
+                        log.warning("No change marker %s in pflegedoku entries, documents are compared by content hash",
+                                    CHANGE_MARKERS)
+                        self.missing_marker_logged = True
+                    if self.touch(url, marker):
+                        continue
+                    downloaded += 1
+                    if self._download(path.format(id=document_entry["id"]), headers, marker)[1]:
+                        changed += 1
+
+        log.info("Sync finished, %s documents downloaded, %s changed", downloaded, changed)
+
+    def _download(self, path, headers, marker=None):
+        """
+        Download a response into the mirror, returns its text (None on errors)
+        and whether its content changed
+        """
+        data = requests.get(self.base_url + path, headers=headers)
+        if data.status_code != 200:
+            log.error("Error at api call during sync - %s %s", data.status_code, path)
+            return None, False
+        return data.text, self.put(self.base_url + path, data.text, marker)
+
+
+class SyncWorker(threading.Thread):
+    """
+    Background thread that syncs a DocumentMirror every interval_seconds
+    """
+
+    def __init__(self, mirror, interval_seconds):
+        super().__init__(name="doc-mirror-sync", daemon=True)
+        self.mirror = mirror
+        self.interval_seconds = interval_seconds
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.mirror.sync()
+            except Exception:
+                log.exception("Sync failed")
+            self.stopped.wait(self.interval_seconds)
+
+    def stop(self):
+        self.stopped.set()
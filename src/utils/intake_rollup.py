@@ -0,0 +1,117 @@
+from collections import defaultdict
+
+from src.utils.api_dates import entry_date
+
+UNKNOWN_DAY = "unbekannt"
+
+
+def _entry_day(entry, sub_entry):
+    """
+    Get the day (YYYY-MM-DD) of a sub entry, falling back to its parent entry
+    """
+    date = entry_date(sub_entry.get("content"), sub_entry, entry.get("content"), entry)
+    return date[:10] if date else UNKNOWN_DAY
+
+
+def _newest_days(days, max_days):
+    """
+    Get the newest max_days day names, newest first, and the number of days left out
+
+    Entries without date are listed last, so truncating the table drops them first
+    """
+    names = sorted((name for name in days if name != UNKNOWN_DAY), reverse=True)
+    if UNKNOWN_DAY in days:
+        names.append(UNKNOWN_DAY)
+    return names[:max_days], max(len(names) - max_days, 0)
+
+
+def _below_target(day_name, amount, target):
+    # entries without date cover an unknown period and are not compared to a daily target
+    return day_name != UNKNOWN_DAY and amount < target
+
+
+def _to_number(value):
+    """
+    Convert an api amount to a number, missing or invalid values count as 0
+    """
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _format_number(value):
+    return str(int(value)) if float(value).is_integer() else str(round(value, 1))
+
+
+def rollup_fluid_balance(entries, target_ml, max_days=14):
+    """
+    Aggregate all fluid balance sub entries per day and fluid in one pass
+
+    Returns a compact table with intake, output and net balance of the newest
+    max_days days, newest first; days with an intake below target_ml are flagged
+    """
+    days = defaultdict(lambda: {"einfuhr": 0.0, "ausfuhr": 0.0, "fluessigkeiten": defaultdict(float)})
+
+    for entry in entries or []:
+        for sub_entry in entry.get("subEintraege") or []:
+            content = sub_entry.get("content") or {}
+            day = days[_entry_day(entry, sub_entry)]
+            intake = _to_number(content.get("einfuhrmenge"))
+            day["einfuhr"] += intake
+            day["ausfuhr"] += _to_number(content.get("ausfuhrmenge"))
+            if intake:
+                day["fluessigkeiten"][str(content.get("fluessigkeit") or "unbekannt")] += intake
+
+    if not days:
+        return ""
+
+    day_names, dropped = _newest_days(days, max_days)
+    lines = ["Tag | Einfuhr ml | Ausfuhr ml | Bilanz ml | Getraenke ml | Hinweis"]
+    for day_name in day_names:
+        day = days[day_name]
+        fluids = ", ".join(name + " " + _format_number(amount) for name, amount in day["fluessigkeiten"].items())
+        hint = "unter Ziel " + _format_number(target_ml) if _below_target(day_name, day["einfuhr"], target_ml) else ""
+        lines.append(" | ".join([day_name, _format_number(day["einfuhr"]), _format_number(day["ausfuhr"]),
+                                 _format_number(day["einfuhr"] - day["ausfuhr"]), fluids or "-", hint or "-"]))
+    if dropped:
+        lines.append("… " + str(dropped) + " weitere Tage")
+    return "\n".join(lines)
+
+
+def rollup_nutrition(entries, target_kcal, max_days=14):
+    """
+    Aggregate all oral nutrition sub entries per day and meal in one pass
+
+    Returns a compact table with the kcal per day and meal of the newest
+    max_days days, newest first; days with less than target_kcal are flagged
+    """
+    days = defaultdict(lambda: {"kcal": 0.0, "mahlzeiten": defaultdict(lambda: {"kcal": 0.0, "lebensmittel": []})})
+
+    for entry in entries or []:
+        for sub_entry in entry.get("subEintraege") or []:
+            content = sub_entry.get("content") or {}
+            day = days[_entry_day(entry, sub_entry)]
+            kcal = _to_number(content.get("kcal"))
+            day["kcal"] += kcal
+            meal = day["mahlzeiten"][str(content.get("mahlzeit") or "unbekannt")]
+            meal["kcal"] += kcal
+            food = str(content.get("lebensmittel") or "")
+            if food and food not in meal["lebensmittel"]:
+                meal["lebensmittel"].append(food)
+
+    if not days:
+        return ""
+
+    day_names, dropped = _newest_days(days, max_days)
+    lines = ["Tag | kcal | Mahlzeiten kcal | Hinweis"]
+    for day_name in day_names:
+        day = days[day_name]
+        meals = "; ".join(name + " " + _format_number(meal["kcal"]) +
+                          (" (" + ", ".join(meal["lebensmittel"]) + ")" if meal["lebensmittel"] else "")
+                          for name, meal in day["mahlzeiten"].items())
+        hint = "unter Ziel " + _format_number(target_kcal) if _below_target(day_name, day["kcal"], target_kcal) else ""
+        lines.append(" | ".join([day_name, _format_number(day["kcal"]), meals or "-", hint or "-"]))
+    if dropped:
+        lines.append("… " + str(dropped) + " weitere Tage")
+    return "\n".join(lines)
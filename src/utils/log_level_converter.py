@@ -12,4 +12,7 @@ def convert_string_to_logger_level(log_level_str):
         "ERROR": log.ERROR,
         "CRITICAL": log.CRITICAL
     }
-    return log_level_map.get(log_level_str.upper(), log.NOTSET)
+    # unset or unknown levels default to INFO, NOTSET on the root logger would log everything
+    if not log_level_str:
+        return log.INFO
+    return log_level_map.get(log_level_str.upper(), log.INFO)
@@ -0,0 +1,100 @@
+import atexit
+import logging as log
+import logging.handlers
+import queue
+import random
+import re
+import threading
+from collections import OrderedDict
+
+# most recently registered names last, the oldest are dropped beyond MAX_NAMES
+MAX_NAMES = 5000
+_names = OrderedDict()
+_names_lock = threading.Lock()
+_names_pattern = None
+
+_payload_sample_rate = 0.0
+
+
+def register_names(*names):
+    """
+    Add resident names that are redacted from every log line
+    """
+    global _names_pattern
+    names = {name.strip() for name in names if isinstance(name, str) and len(name.strip()) > 1}
+    with _names_lock:
+        for name in names & _names.keys():
+            _names.move_to_end(name)
+        new_names = names - _names.keys()
+        if not new_names:
+            return
+        for name in new_names:
+            _names[name] = None
+        while len(_names) > MAX_NAMES:
+            _names.popitem(last=False)
+        # whole words only, so "Anna" does not redact "Annahme"
+        _names_pattern = re.compile(r"\b(?:" + "|".join(re.escape(name) for name in sorted(_names, key=len, reverse=True)) + r")\b")
+
+
+def redact(text):
+    """
+    Replace registered resident names in a text
+    """
+    pattern = _names_pattern
+    return pattern.sub("[Klient]", text) if pattern is not None else text
+
+
+class Payload:
+    """
+    Large text (tool result, answer) as log argument, formatted lazily
+
+    Only its size is written, a sampled share of payloads adds its structure
+    (lines, words, truncation markers). The text itself is never written, as
+    it holds health data.
+    """
+    __slots__ = ("text", "sampled")
+
+    def __init__(self, text):
+        self.text = text
+        self.sampled = _payload_sample_rate > 0 and random.random() < _payload_sample_rate
+
+    def __str__(self):
+        size = "<" + str(len(self.text)) + " Zeichen>"
+        if not self.sampled:
+            return size
+        lines = self.text.count("\n") + 1
+        words = len(self.text.split())
+        truncated = len(re.findall(r"… (?:\d+ weitere|gekürzt)", self.text))
+        return size + " Zeilen=" + str(lines) + " Woerter=" + str(words) + " Kuerzungen=" + str(truncated)
+
+
+class RedactingFormatter(log.Formatter):
+    def format(self, record):
+        return redact(super().format(record))
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # formatting is left to the listener thread
+        return record
+
+
+def setup(level, fmt, datefmt, payload_sample_rate=0.0):
+    """
+    Log through a queue, so formatting, redaction and writing run in a background thread
+    """
+    global _payload_sample_rate
+    _payload_sample_rate = payload_sample_rate
+
+    stream_handler = log.StreamHandler()
+    stream_handler.setFormatter(RedactingFormatter(fmt, datefmt))
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = log.getLogger()
+    root.setLevel(level)
+    root.addHandler(_LazyQueueHandler(log_queue))
+    return listener
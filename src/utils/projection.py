@@ -0,0 +1,186 @@
+from dataclasses import dataclass, fields as dataclass_fields
+from typing import ClassVar
+
+
+def _lookup(raw, path):
+    """
+    Resolve a dotted path like "person.vorname" in a parsed api response
+
+    A leading "*" matches the first nested dict that contains the remaining key
+    """
+    if path.startswith("*."):
+        key = path[2:]
+        for content in raw.values():
+            if isinstance(content, dict) and content.get(key) is not None:
+                return content[key]
+        return None
+
+    value = raw
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def project(raw, record_type):
+    """
+    Build a compact record from a parsed api response, only the declared paths are read
+    """
+    if not isinstance(raw, dict):
+        return record_type()
+    return record_type(**{name: _lookup(raw, path) for name, path in record_type.PATHS.items()})
+
+
+def serialize(record, wanted_fields=None):
+    """
+    Serialize a record tersely as "feld: wert; ...", empty values are left out
+    """
+    names = wanted_fields or [field.name for field in dataclass_fields(record)]
+    parts = []
+    for name in names:
+        value = getattr(record, name)
+        if value is None or value == "" or value == [] or value == {}:
+            continue
+        parts.append(name + ": " + str(value).strip())
+    return "; ".join(parts)
+
+
+def _is_id(key):
+    return key.lower() == "id" or key.endswith("Id")
+
+
+def _serialize_nested(raw, include, prefix="", matched=False):
+    """
+    Serialize the non empty scalar values of a nested response for which
+    include(key, matched) is true, matched tells if an enclosing key matched
+    """
+    parts = []
+    if not isinstance(raw, dict):
+        return ""
+    for key, value in raw.items():
+        if isinstance(value, dict):
+            nested = _serialize_nested(value, include, prefix + key + ".", matched or include(key, False))
+            if nested:
+                parts.append(nested)
+        elif value not in (None, "") and not isinstance(value, list) and not _is_id(key) and include(key, matched):
+            parts.append(prefix + key + ": " + str(value).strip())
+    return "; ".join(parts)
+
+
+def serialize_matching(raw, key_parts):
+    """
+    Serialize all non empty scalar values of a nested response whose key, or
+    the key of an enclosing dict, contains one of key_parts; ids are left out.
+    Used when a declared path does not match the response.
+    """
+    return _serialize_nested(raw, lambda key, matched: matched or any(part in key.lower() for part in key_parts))
+
+
+def serialize_unmatched(raw, record_type):
+    """
+    Serialize all non empty scalar values of a nested response that no declared path of record_type reads
+    """
+    declared = {path.split(".")[-1] for path in record_type.PATHS.values()}
+    return _serialize_nested(raw, lambda key, matched: key not in declared)
+
+
+def serialize_fallback(raw, record, wanted_fields=None):
+    """
+    Serialize the values a record missed: for every wanted field that stayed
+    empty, the response is searched for the key parts in FALLBACK_KEYS
+    """
+    names = wanted_fields or [field.name for field in dataclass_fields(record)]
+    key_parts = set()
+    for name in names:
+        if getattr(record, name) in (None, ""):
+            key_parts.update(record.FALLBACK_KEYS.get(name, ()))
+    if not key_parts:
+        return ""
+    return serialize_matching(raw, key_parts)
+
+
+# the client paths are taken from the fields used elsewhere (person.name,
+# person.vorname) and otherwise not confirmed by an api response, see
+# serialize_fallback for missed fields
+@dataclass(slots=True)
+class ClientRecord:
+    PATHS: ClassVar[dict] = {
+        "vorname": "person.vorname",
+        "name": "person.name",
+        "geburtsdatum": "person.geburtsdatum",
+        "geschlecht": "person.geschlecht",
+        "strasse": "adresse.strasse",
+        "hausnummer": "adresse.hausnummer",
+        "plz": "adresse.plz",
+        "ort": "adresse.ort",
+        "telefon": "person.telefon",
+        "pflegegrad": "pflegegrad",
+    }
+    FALLBACK_KEYS: ClassVar[dict] = {
+        "geburtsdatum": ("geburt",),
+        "geschlecht": ("geschlecht",),
+        "strasse": ("adress", "anschrift", "strasse"),
+        "hausnummer": ("adress", "anschrift", "hausnummer"),
+        "plz": ("adress", "anschrift", "plz", "postleitzahl"),
+        "ort": ("adress", "anschrift", "wohnort", "ort"),
+        "telefon": ("telefon", "mobil"),
+        "pflegegrad": ("pflegegrad",),
+    }
+
+    vorname: str | None = None
+    name: str | None = None
+    geburtsdatum: str | None = None
+    geschlecht: str | None = None
+    strasse: str | None = None
+    hausnummer: str | None = None
+    plz: str | None = None
+    ort: str | None = None
+    telefon: str | None = None
+    pflegegrad: str | None = None
+
+
+@dataclass(slots=True)
+class SisRecord:
+    PATHS: ClassVar[dict] = {
+        "momentaner_standpunkt": "*.momentanerStandpunkt",
+        "kognition_und_kommunikation": "*.themenfeld1",
+        "mobilitaet_und_beweglichkeit": "*.themenfeld2",
+        "krankheitsbezogene_anforderungen": "*.themenfeld3",
+        "selbstversorgung": "*.themenfeld4",
+        "soziale_beziehungen": "*.themenfeld5",
+        "haushaltsfuehrung": "*.themenfeld6",
+    }
+
+    momentaner_standpunkt: str | None = None
+    kognition_und_kommunikation: str | None = None
+    mobilitaet_und_beweglichkeit: str | None = None
+    krankheitsbezogene_anforderungen: str | None = None
+    selbstversorgung: str | None = None
+    soziale_beziehungen: str | None = None
+    haushaltsfuehrung: str | None = None
+
+
+# none of the Sturzprotokoll keys is confirmed by an api response, fields the
+# projection does not read are appended with serialize_unmatched
+@dataclass(slots=True)
+class SturzprotokollRecord:
+    PATHS: ClassVar[dict] = {
+        "zeitpunkt": "*.sturzzeitpunkt",
+        "ort": "*.sturzort",
+        "hergang": "*.sturzhergang",
+        "ursache": "*.sturzursache",
+        "verletzungen": "*.verletzungen",
+        "massnahmen": "*.massnahmen",
+        "arzt_informiert": "*.arztInformiert",
+        "angehoerige_informiert": "*.angehoerigeInformiert",
+    }
+
+    zeitpunkt: str | None = None
+    ort: str | None = None
+    hergang: str | None = None
+    ursache: str | None = None
+    verletzungen: str | None = None
+    massnahmen: str | None = None
+    arzt_informiert: str | None = None
+    angehoerige_informiert: str | None = None
@@ -0,0 +1,134 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def chunk_text(text, max_chars=500):
+    """
+    Split a free text into chunks of whole sentences with at most max_chars characters
+    """
+    chunks = []
+    current = ""
+    for sentence in re.split(r"(?<=[.!?])\s+|\n+", text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if current and len(current) + len(sentence) + 1 > max_chars:
+            chunks.append(current)
+            current = ""
+        current = (current + " " + sentence).strip()
+        while len(current) > max_chars:
+            chunks.append(current[:max_chars])
+            current = current[max_chars:]
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class ClientIndex:
+    """
+    Embedding index over the free text documents of one client
+
+    Documents are chunked and embedded once, documents whose text changed are re-embedded
+    """
+
+    def __init__(self, embed, max_chars=500):
+        self.embed = embed
+        self.max_chars = max_chars
+        self.vectors = None
+        self.chunks = []
+        self.chunk_document_ids = []
+        self.document_hashes = {}
+        self.lock = threading.Lock()
+
+    def add(self, documents):
+        """
+        Sync the index with the complete (document_id, text) pairs of its document,
+        only new or changed documents are embedded and missing ones are removed
+        """
+        documents = list(documents)
+        with self.lock:
+            # documents deleted or cleared upstream must not be found any more
+            present = {document_id for document_id, text in documents}
+            for document_id in [document_id for document_id in self.document_hashes if document_id not in present]:
+                self._remove(document_id)
+                del self.document_hashes[document_id]
+
+            changed = {}
+            new_chunks = []
+            new_document_ids = []
+            for document_id, text in documents:
+                text_hash = hashlib.sha1(text.encode("utf-8")).hexdigest()
+                if self.document_hashes.get(document_id) == text_hash or changed.get(document_id) == text_hash:
+                    continue
+                changed[document_id] = text_hash
+                for chunk in chunk_text(text, self.max_chars):
+                    new_chunks.append(chunk)
+                    new_document_ids.append(document_id)
+
+            if not changed:
+                return
+
+            # embed first, so a failed embedding leaves the index unchanged and is retried on the next add
+            vectors = self._normalize(np.asarray(self.embed(new_chunks), dtype=np.float32)) if new_chunks else None
+
+            for document_id, text_hash in changed.items():
+                if document_id in self.document_hashes:
+                    self._remove(document_id)
+                self.document_hashes[document_id] = text_hash
+            if vectors is None:
+                return
+            self.vectors = vectors if self.vectors is None else np.vstack([self.vectors, vectors])
+            self.chunks.extend(new_chunks)
+            self.chunk_document_ids.extend(new_document_ids)
+
+    def search(self, query, top_k):
+        """
+        Get the top_k chunks most similar to the query, in order of similarity
+        """
+        with self.lock:
+            if self.vectors is None or not self.chunks:
+                return []
+            query_vector = self._normalize(np.asarray(self.embed([query]), dtype=np.float32))[0]
+            scores = self.vectors @ query_vector
+            top_k = min(top_k, len(self.chunks))
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+            return [self.chunks[index] for index in best[np.argsort(-scores[best])]]
+
+    def _remove(self, document_id):
+        keep = np.array([chunk_document_id != document_id for chunk_document_id in self.chunk_document_ids], dtype=bool)
+        self.vectors = self.vectors[keep] if self.vectors is not None and keep.any() else None
+        self.chunks = [chunk for chunk, kept in zip(self.chunks, keep) if kept]
+        self.chunk_document_ids = [chunk_id for chunk_id, kept in zip(self.chunk_document_ids, keep) if kept]
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+
+# key -> (index, last use), least recently used first
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_index(key, embed, max_indexes=500, max_idle_seconds=8 * 60 * 60):
+    """
+    Get the index for a client document, it is created on first use
+
+    Indexes unused for max_idle_seconds and the least recently used ones
+    beyond max_indexes are dropped and rebuilt when needed again
+    """
+    now = time.monotonic()
+    with _indexes_lock:
+        index = _indexes.pop(key, (None, now))[0] or ClientIndex(embed)
+        _indexes[key] = (index, now)
+        while next(iter(_indexes)) != key and (len(_indexes) > max_indexes or
+                                               now - next(iter(_indexes.values()))[1] > max_idle_seconds):
+            _indexes.popitem(last=False)
+        return index
@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+
+
+class SessionStore:
+    """
+    Conversation histories of many sessions, keyed by session id
+
+    Histories are kept zlib compressed. When the stored size exceeds max_bytes
+    the least recently used sessions are evicted, or spilled to spill_dir if
+    it is set. Sessions idle for longer than max_idle_seconds are dropped, also
+    from disk, and spilled files beyond max_spill_bytes are deleted oldest
+    first; a background sweep checks this every sweep_interval_seconds.
+    The store is guarded by a lock, so it can be shared between threads; from
+    asyncio call it via asyncio.to_thread.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_idle_seconds=8 * 60 * 60, spill_dir=None,
+                 max_spill_bytes=512 * 1024 * 1024, sweep_interval_seconds=60):
+        self.max_bytes = max_bytes
+        self.max_idle_seconds = max_idle_seconds
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.sessions = OrderedDict()
+        self.spilling = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.session_locks = weakref.WeakValueDictionary()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+        if sweep_interval_seconds:
+            self.stopped = threading.Event()
+            threading.Thread(target=self._sweep_periodically, args=(sweep_interval_seconds,),
+                             name="session-store-sweep", daemon=True).start()
+
+    def session_lock(self, session_id):
+        """
+        Get the lock that serializes the turns of a session, hold it from get to put
+        """
+        with self.lock:
+            session_lock = self.session_locks.get(session_id)
+            if session_lock is None:
+                session_lock = threading.Lock()
+                self.session_locks[session_id] = session_lock
+            return session_lock
+
+    def get(self, session_id):
+        """
+        Get the conversation of a session, an empty list for unknown sessions
+        """
+        with self.lock:
+            if session_id in self.sessions:
+                self.sessions.move_to_end(session_id)
+                data, _ = self.sessions[session_id]
+                return json.loads(zlib.decompress(data))
+            if session_id in self.spilling:
+                data, _ = self.spilling[session_id]
+                return json.loads(zlib.decompress(data))
+        return self._load_spilled(session_id)
+
+    def put(self, session_id, messages):
+        """
+        Store the conversation of a session and evict sessions over the limits
+        """
+        data = zlib.compress(json.dumps(messages, ensure_ascii=False).encode("utf-8"))
+        with self.lock:
+            self._drop(session_id)
+            self.sessions[session_id] = (data, time.time())
+            self.size += len(data)
+            victims = self._evict()
+        self._spill(victims)
+
+    def delete(self, session_id):
+        """
+        Remove a session, also from disk
+        """
+        with self.lock:
+            self._drop(session_id)
+        if self.spill_dir and os.path.exists(self._spill_path(session_id)):
+            os.remove(self._spill_path(session_id))
+
+    def sweep(self):
+        """
+        Drop idle sessions from memory and disk and keep the spilled files below max_spill_bytes
+        """
+        with self.lock:
+            victims = self._evict()
+        self._spill(victims)
+        if not self.spill_dir:
+            return
+
+        spilled = []
+        for file_name in os.listdir(self.spill_dir):
+            if not file_name.endswith(".session"):
+                continue
+            path = os.path.join(self.spill_dir, file_name)
+            try:
+                spilled.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except FileNotFoundError:
+                continue
+
+        spill_size = sum(size for _, size, _ in spilled)
+        for last_used, size, path in sorted(spilled):
+            if time.time() - last_used <= self.max_idle_seconds and spill_size <= self.max_spill_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            spill_size -= size
+
+    def stop(self):
+        """
+        Stop the background sweep
+        """
+        if hasattr(self, "stopped"):
+            self.stopped.set()
+
+    def _sweep_periodically(self, interval_seconds):
+        while not self.stopped.wait(interval_seconds):
+            self.sweep()
+
+    def _drop(self, session_id):
+        if session_id in self.sessions:
+            data, _ = self.sessions.pop(session_id)
+            self.size -= len(data)
+
+    def _evict(self):
+        """
+        Remove sessions over the limits from memory, returns the ones to spill to disk
+        """
+        victims = []
+        now = time.time()
+        while self.sessions:
+            session_id, (data, last_used) = next(iter(self.sessions.items()))
+            idle = now - last_used > self.max_idle_seconds
+            if self.size <= self.max_bytes and not idle:
+                break
+            self._drop(session_id)
+            # idle sessions are expired and not kept on disk
+            if self.spill_dir and not idle:
+                self.spilling[session_id] = (data, last_used)
+                victims.append(session_id)
+        return victims
+
+    def _spill(self, victims):
+        # disk writes happen outside the store lock, get reads from spilling meanwhile
+        for session_id in victims:
+            with self.lock:
+                entry = self.spilling.get(session_id)
+            if entry is None:
+                continue
+            data, last_used = entry
+            path = self._spill_path(session_id)
+            with open(path + ".tmp", "wb") as spill_file:
+                spill_file.write(data)
+            # the file time is the last use, so the sweep expires it after max_idle_seconds
+            os.utime(path + ".tmp", (last_used, last_used))
+            os.replace(path + ".tmp", path)
+            with self.lock:
+                if self.spilling.get(session_id) is entry:
+                    del self.spilling[session_id]
+
+    def _load_spilled(self, session_id):
+        if not self.spill_dir:
+            return []
+        path = self._spill_path(session_id)
+        try:
+            with open(path, "rb") as spill_file:
+                data = spill_file.read()
+            last_used = os.path.getmtime(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return []
+        if time.time() - last_used > self.max_idle_seconds:
+            return []
+
+        with self.lock:
+            if session_id not in self.sessions:
+                self.sessions[session_id] = (data, time.time())
+                self.size += len(data)
+            victims = self._evict()
+        self._spill(victims)
+        return json.loads(zlib.decompress(data))
+
+    def _spill_path(self, session_id):
+        return os.path.join(self.spill_dir, str(zlib.crc32(session_id.encode("utf-8"))) + "_" +
+                            "".join(char for char in session_id if char.isalnum())[:64] + ".session")
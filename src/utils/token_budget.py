@@ -0,0 +1,119 @@
+import contextvars
+import re
+
+# state of the current agent turn, set by agent() and read by the tools
+_remaining_tokens = contextvars.ContextVar("remaining_tokens", default=None)
+_question = contextvars.ContextVar("question", default="")
+
+MIN_BUDGET = 64
+
+
+def estimate_tokens(text):
+    """
+    Estimate the token count of a text locally, roughly 4 characters per token
+    """
+    return (len(text) + 3) // 4
+
+
+def start_turn(remaining_tokens, question=""):
+    """
+    Set the context left in the current turn and the question it answers
+    """
+    _remaining_tokens.set(max(remaining_tokens, 0))
+    _question.set(question or "")
+
+
+def consume(text):
+    """
+    Subtract a tool output from the context left in the current turn
+    """
+    remaining = _remaining_tokens.get()
+    if remaining is not None:
+        _remaining_tokens.set(max(remaining - estimate_tokens(text), 0))
+
+
+def trim_turns(messages, max_tokens):
+    """
+    Drop the oldest turns of a conversation until it fits max_tokens
+
+    System messages and the latest turn are always kept, a turn starts with a user message
+    """
+    system = [message for message in messages if message["role"] == "system"]
+    rest = [message for message in messages if message["role"] != "system"]
+    used = sum(estimate_tokens(str(message["content"])) for message in system)
+
+    kept = []
+    turn = []
+    for message in reversed(rest):
+        turn.insert(0, message)
+        if message["role"] != "user":
+            continue
+        cost = sum(estimate_tokens(str(turn_message["content"])) for turn_message in turn)
+        if kept and used + cost > max_tokens:
+            break
+        kept = turn + kept
+        used += cost
+        turn = []
+    return system + kept
+
+
+def budget(configured_tokens):
+    """
+    Get the token budget of a tool, limited by the context left in the current turn
+    """
+    remaining = _remaining_tokens.get()
+    if remaining is None:
+        return configured_tokens
+    return max(min(configured_tokens, remaining), MIN_BUDGET)
+
+
+def current_question():
+    """
+    Get the question of the current turn
+    """
+    return _question.get()
+
+
+def rank_by_question(texts):
+    """
+    Order texts by the number of words they share with the current question,
+    texts with the same score keep their order
+    """
+    words = {word for word in re.findall(r"\w+", _question.get().lower()) if len(word) > 3}
+    if not words:
+        return list(texts)
+    return sorted(texts, key=lambda text: -len(words & set(re.findall(r"\w+", text.lower()))))
+
+
+def truncate_entries(entries, budget_tokens, separator="\n"):
+    """
+    Join entries in priority order until the budget is used up, the dropped
+    entries are replaced by a "… N weitere Einträge" marker
+    """
+    kept = []
+    used = 0
+    marker_reserve = estimate_tokens(separator + "… 9999 weitere Einträge")
+    for index, entry in enumerate(entries):
+        cost = estimate_tokens(entry + separator)
+        limit = budget_tokens if index == len(entries) - 1 else budget_tokens - marker_reserve
+        if used + cost > limit:
+            if not kept:
+                # keep at least the beginning of the most important entry
+                kept.append(truncate_text(entry, limit))
+                index += 1
+            if len(entries) - index:
+                kept.append("… " + str(len(entries) - index) + " weitere Einträge")
+            break
+        kept.append(entry)
+        used += cost
+    return separator.join(kept)
+
+
+def truncate_text(text, budget_tokens):
+    """
+    Cut a text to the budget, marking the cut
+    """
+    if estimate_tokens(text) <= budget_tokens:
+        return text
+    marker = " … gekürzt"
+    return text[:max(budget_tokens * 4 - len(marker), 0)].rstrip() + marker